@@ -7,14 +7,22 @@ Command-line tool for simulating predictive datasets from MrBayes' output.
 
 import argparse
 import csv
+import json
 import os
+import random
+import re
 import shutil
+import socket
+import socketserver
+import stat
 import sys
+import time
 
-from collections import namedtuple
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
-from itertools import islice
-from math import fabs
+from itertools import chain, islice, repeat, zip_longest
+from math import fabs, log, sqrt
 
 import dendropy
 
@@ -27,9 +35,23 @@ __version__ = '0.7.0'
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
+    if args[:1] == ['serve']:
+        return serve(args[1:])
     parser = parse_args(args)
-    tree_list = read_tfile(parser.tfile_path, parser.skip, parser.num_records)
-    p_dicts = read_pfile(parser.pfile_path, parser.skip, parser.num_records)
+    if parser.follow:
+        records = follow_records(
+            parser.pfile_path, parser.tfile_path, skip=parser.skip,
+            thin=parser.thin, num_records=parser.num_records,
+            state_filepath=parser.state_filepath,
+            timeout=parser.follow_timeout)
+    else:
+        records = iter_records(
+            parser.run_paths, skip=parser.skip,
+            burnin_frac=parser.burnin_frac, thin=parser.thin,
+            num_records=parser.num_records)
+    if parser.sample_size is not None:
+        records = sample_records(
+            records, parser.sample_size, rng_seed=parser.sample_seed)
     if parser.seeds_filepath:
         with open(parser.seeds_filepath, 'r') as seeds_fo:
             lines = seeds_fo.readlines()
@@ -37,16 +59,26 @@ def main(args=None):
     else:
         rng_seeds = None
 
-    simulation_input = combine_simulation_input(tree_list, p_dicts, rng_seeds)
+    if parser.observed_matrix is not None:
+        records = check_taxon_labels(
+            records, [taxon.label for taxon in parser.observed_matrix])
+
+    simulation_input = iter_simulation_input(records, rng_seeds)
 
     result_iterator = iter_seqgen_results(
         simulation_input, seq_len=parser.length, gamma_cats=parser.gamma_cats,
-        basefreqs=parser.basefreqs, seqgen_path=parser.sg_filepath)
+        basefreqs=parser.basefreqs, seqgen_path=parser.sg_filepath,
+        partition_lengths=parser.partition_lengths)
+
+    if parser.observed_matrix is not None:
+        statistic_func = TEST_STATISTICS[parser.statistic]
+        result_iterator = iter_predictive_tests(
+            result_iterator, statistic_func(parser.observed_matrix),
+            statistic_func)
+    else:
+        result_iterator = ((result, None) for result in result_iterator)
 
-    if parser.out_format == 'nexus':
-        schema_kwargs = {'schema': 'nexus', 'simple': False}
-    elif parser.out_format == 'phylip':
-        schema_kwargs = {'schema': 'phylip'}
+    schema_kwargs = OUTPUT_SCHEMAS[parser.out_format]
 
     with ExitStack() as cm:  # write to multiple files simultaneously
         write_funcs = []
@@ -59,40 +91,133 @@ def main(args=None):
             trees_fo = cm.enter_context(open(parser.trees_filepath, 'w'))
             write_funcs.append(get_write_func(trees_fo, 'tree'))
 
-        for result in result_iterator:
-            sys.stdout.write(result.char_matrix.as_string(**schema_kwargs))
-            for write_func in write_funcs:
-                write_func(result)
+        test = None
+        stop_reason = 'no more records'
+        try:
+            for num_replicates, (result, test) in enumerate(
+                    result_iterator, start=1):
+                sys.stdout.write(
+                    result.char_matrix.as_string(**schema_kwargs))
+                sys.stdout.flush()
+                for write_func in write_funcs:
+                    write_func(result)
+                if (parser.precision is not None and
+                        test.pvalue_se <= parser.precision):
+                    stop_reason = 'precision reached'
+                    break
+                if (parser.max_replicates is not None and
+                        num_replicates >= parser.max_replicates):
+                    stop_reason = 'maximum number of replicates reached'
+                    break
+        except KeyboardInterrupt:  # the way to stop --follow without timeout
+            stop_reason = 'interrupted'
+
+    if test is not None:
+        sys.stderr.write(format_predictive_test(test, stop_reason))
+
+
+def serve(args):
+    parser = parse_serve_args(args)
+    try:
+        records = list(iter_records(
+            parser.run_paths, skip=parser.skip,
+            burnin_frac=parser.burnin_frac, thin=parser.thin,
+            num_records=parser.num_records))
+        check_model_params(
+            records, basefreqs=parser.basefreqs,
+            partition_lengths=parser.partition_lengths)
+    except (KeyError, ValueError) as exc:
+        sys.exit('predsim serve: error: ' + format_error(exc))
+    try:
+        remove_stale_socket(parser.socket_path)
+        server = PosteriorServer(
+            parser.socket_path, records, max_workers=parser.max_workers,
+            gamma_cats=parser.gamma_cats, basefreqs=parser.basefreqs,
+            seqgen_path=parser.sg_filepath,
+            partition_lengths=parser.partition_lengths)
+    except OSError as exc:
+        sys.exit('predsim serve: error: ' + str(exc))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(parser.socket_path)
+
+
+OUTPUT_SCHEMAS = {
+    'nexus': {'schema': 'nexus', 'simple': False},
+    'phylip': {'schema': 'phylip'}}
 
 
 def parse_args(args):
     parser = argparse.ArgumentParser(
         prog='predsim', description=(
             'A command-line utility that reads posterior output of MrBayes '
-            'and simulates predictive datasets with Seq-Gen.'))
+            'and simulates predictive datasets with Seq-Gen.'),
+        epilog=(
+            'Run "predsim serve -h" for help on keeping the posterior '
+            'in memory for repeated simulations.'))
     parser.add_argument(
         '-V', '--version', action='version', version='%(prog)s ' + __version__)
     parser.add_argument(
-        '-l', '--length', action='store', default=1000, type=int,
-        help='sequence lenght (default: 1000)', metavar='N', dest='length')
+        '-l', '--length', action='store', default=None, type=int,
+        help=(
+            'sequence lenght (default: length of the observed alignment, '
+            'if given, otherwise 1000; not used for partitioned analyses, '
+            'see --partition-lengths)'),
+        metavar='N', dest='length')
+    add_model_arguments(parser)
+    add_record_arguments(parser)
     parser.add_argument(
-        '-f', '--freqs', action='store', type=float, nargs=4,
+        '--sample', action='store', default=None, type=is_positive_int,
         help=(
-            'base frequences (overrides any base frequences '
-            'in MrBayes\' output)'),
-        metavar=('#A', '#C', '#G', '#T'), dest='basefreqs')
+            'number of records (trees) to draw at random from the '
+            'selected records'), metavar='N', dest='sample_size')
     parser.add_argument(
-        '-g', '--gamma-cats', action='store', type=int,
-        help='number of gamma rate categories (default: continuous)',
-        metavar='N', dest='gamma_cats')
+        '--sample-seed', action='store', default=None, type=int,
+        help='seed number for drawing records at random',
+        metavar='N', dest='sample_seed')
     parser.add_argument(
-        '-s', '--skip', action='store', default=0, type=int, help=(
-            'number of records (trees) to skip at the beginning '
-            'of the sample (default: 0)'), metavar='N', dest='skip')
+        '--follow', action='store_true', help=(
+            'keep reading records as they are appended to the p-file '
+            'and t-file of a running analysis'), dest='follow')
     parser.add_argument(
-        '-n', '--num-records', action='store', default=None, type=int,
-        help='number of records (trees) to use in the simulation',
-        metavar='N', dest='num_records')
+        '--follow-timeout', action='store', default=None, type=float,
+        help=(
+            'stop following after this many seconds without new records '
+            '(default: never)'), metavar='SECONDS', dest='follow_timeout')
+    parser.add_argument(
+        '--state-file', action=StoreExpandedPath, type=str, help=(
+            'path to file for storing the position in the p-file and '
+            't-file when following them'),
+        metavar='FILE', dest='state_filepath')
+    parser.add_argument(
+        '--observed', action=StoreExpandedPath, type=is_file, help=(
+            'path to observed alignment for calculating a posterior '
+            'predictive p-value'), metavar='FILE', dest='observed_filepath')
+    parser.add_argument(
+        '--observed-format', default='nexus',
+        choices=['nexus', 'phylip', 'fasta'],
+        help='format of the observed alignment (default: "nexus")',
+        dest='observed_format')
+    parser.add_argument(
+        '--statistic', default='multinomial',
+        choices=sorted(TEST_STATISTICS),
+        help='test statistic for the p-value (default: "multinomial")',
+        dest='statistic')
+    parser.add_argument(
+        '--precision', action='store', default=None,
+        type=is_positive_float, help=(
+            'stop when the Monte Carlo standard error of the p-value '
+            'is at most this positive value'), metavar='SE',
+        dest='precision')
+    parser.add_argument(
+        '--max-replicates', action='store', default=None,
+        type=is_positive_int, help=(
+            'maximum number of datasets to simulate (default: no limit)'),
+        metavar='N', dest='max_replicates')
     parser.add_argument(
         '-o', '--out-format', default='nexus', choices=['nexus', 'phylip'],
         help='output format (default: "nexus")', dest='out_format')
@@ -112,14 +237,141 @@ def parse_args(args):
         '--trees-file', action=StoreExpandedPath, type=str,
         help='path to output file with trees used by Seq-Gen',
         metavar='FILE', dest='trees_filepath')
+    add_run_arguments(parser)
+
+    namespace = parser.parse_args(args)
+    set_run_paths(parser, namespace)
+    if namespace.follow and (
+            namespace.extra_paths or namespace.burnin_frac is not None or
+            namespace.sample_size is not None):
+        parser.error(
+            '--follow cannot be combined with additional runs, '
+            '--burnin-frac or --sample')
+    if namespace.sample_seed is not None and namespace.sample_size is None:
+        parser.error('--sample-seed requires --sample')
+    if namespace.precision is not None and namespace.observed_filepath is None:
+        parser.error('--precision requires --observed')
+    namespace.observed_matrix = None
+    if namespace.observed_filepath is not None:
+        namespace.observed_matrix = dendropy.DnaCharacterMatrix.get(
+            path=namespace.observed_filepath,
+            schema=namespace.observed_format)
+        try:
+            check_observed_matrix(namespace.observed_matrix)
+        except ValueError as exc:
+            parser.error(str(exc))
+        observed_len = namespace.observed_matrix.sequence_size
+        if namespace.length is None:
+            namespace.length = observed_len
+        if namespace.partition_lengths is not None:
+            simulated_len = sum(namespace.partition_lengths)
+        else:
+            simulated_len = namespace.length
+        if simulated_len != observed_len:
+            parser.error(
+                'the simulated sequence length ({0}) does not match the '
+                'length of the observed alignment ({1})'.format(
+                    simulated_len, observed_len))
+    if namespace.length is None:
+        namespace.length = 1000
+    return namespace
+
+
+def parse_serve_args(args):
+    parser = argparse.ArgumentParser(
+        prog='predsim serve', description=(
+            'Read posterior output of MrBayes once and simulate predictive '
+            'datasets with Seq-Gen on request. Requests are read as JSON '
+            'from a Unix socket.'))
+    add_model_arguments(parser)
+    add_record_arguments(parser)
+    parser.add_argument(
+        '-p', '--seqgen-path', default='seq-gen', type=str,
+        help='path to a Seq-Gen executable (default: "seq-gen")',
+        metavar='FILE', dest='sg_filepath')
+    parser.add_argument(
+        '-w', '--workers', action='store', default=None,
+        type=is_positive_int, help=(
+            'number of requests to handle concurrently '
+            '(default: based on the number of processors)'),
+        metavar='N', dest='max_workers')
+    parser.add_argument(
+        'socket_path', action=StoreExpandedPath, type=str,
+        help='path to the Unix socket to listen on', metavar='socket')
+    add_run_arguments(parser)
+
+    namespace = parser.parse_args(args)
+    set_run_paths(parser, namespace)
+    return namespace
+
+
+def add_model_arguments(parser):
+    """Add arguments for substitution model settings to a parser."""
+    parser.add_argument(
+        '--partition-lengths', action='store', default=None,
+        type=is_positive_int_list, help=(
+            'comma-separated sequence lengths of the partitions in a '
+            'partitioned analysis'), metavar='N,N,...',
+        dest='partition_lengths')
+    parser.add_argument(
+        '-f', '--freqs', action='store', type=float, nargs=4,
+        help=(
+            'base frequences (overrides any base frequences '
+            'in MrBayes\' output; for partitioned analyses, only used '
+            'for partitions without base frequences)'),
+        metavar=('#A', '#C', '#G', '#T'), dest='basefreqs')
+    parser.add_argument(
+        '-g', '--gamma-cats', action='store', type=int,
+        help='number of gamma rate categories (default: continuous)',
+        metavar='N', dest='gamma_cats')
+
+
+def add_record_arguments(parser):
+    """Add arguments for selecting records to a parser."""
+    burnin_group = parser.add_mutually_exclusive_group()
+    burnin_group.add_argument(
+        '-s', '--skip', action='store', default=0, type=int, help=(
+            'number of records (trees) to skip at the beginning '
+            'of each run (default: 0)'), metavar='N', dest='skip')
+    burnin_group.add_argument(
+        '--burnin-frac', action='store', default=None, type=is_fraction,
+        help=(
+            'fraction of records (trees) to skip at the beginning '
+            'of each run'), metavar='F', dest='burnin_frac')
+    parser.add_argument(
+        '-t', '--thin', action='store', default=1, type=is_positive_int,
+        help=(
+            'use every Nth record (tree) after the skipped records '
+            '(default: 1)'), metavar='N', dest='thin')
+    parser.add_argument(
+        '-n', '--num-records', action='store', default=None, type=int,
+        help='number of records (trees) to use in the simulation',
+        metavar='N', dest='num_records')
+
+
+def add_run_arguments(parser):
+    """Add positional arguments for p-files and t-files to a parser."""
     parser.add_argument(
         'pfile_path', action=StoreExpandedPath, type=is_file,
         help='path to a MrBayes p-file', metavar='pfile')
     parser.add_argument(
         'tfile_path', action=StoreExpandedPath, type=is_file,
         help='path to a MrBayes t-file', metavar='tfile')
+    parser.add_argument(
+        'extra_paths', action=StoreExpandedPath, type=is_file, nargs='*',
+        default=[], help=(
+            'paths to p-files and t-files of additional runs, '
+            'given in pairs'), metavar='pfile tfile')
+
 
-    return parser.parse_args(args)
+def set_run_paths(parser, namespace):
+    """Pair the p-files and t-files of all runs in a parsed namespace."""
+    if len(namespace.extra_paths) % 2 != 0:
+        parser.error(
+            'p-files and t-files of additional runs must be given in pairs')
+    namespace.run_paths = [(namespace.pfile_path, namespace.tfile_path)]
+    namespace.run_paths.extend(
+        zip(namespace.extra_paths[::2], namespace.extra_paths[1::2]))
 
 
 def read_tfile(filepath, skip=0, num_records=None):
@@ -176,13 +428,390 @@ def read_pfile(filepath, skip=0, num_records=None):
     return p_dicts
 
 
+def iter_tfile(
+        filepath, skip=0, num_records=None, thin=1, taxon_namespace=None):
+    """
+    Iterate lazily over the trees in a MrBayes t-file.
+
+    Parameters
+    ----------
+    filepath : str
+    skip : int
+        Number of records to skip in the beginning of the file.
+    num_records : int
+        Number of records to yield after the skipped records.
+    thin : int
+        Yield every `thin`th record after the skipped records.
+    taxon_namespace : dendropy.TaxonNamespace
+        Namespace to share between trees from different files.
+
+    Yields
+    ------
+    tree : dendropy.Tree
+    """
+    trees = dendropy.Tree.yield_from_files(
+        [filepath], 'nexus', taxon_namespace=taxon_namespace)
+    return islice(islice(trees, skip, None, thin), num_records)
+
+
+def iter_pfile(filepath, skip=0, num_records=None, thin=1):
+    """
+    Iterate lazily over the records in a MrBayes p-file.
+
+    Parameters
+    ----------
+    filepath : str
+    skip : int
+        Number of records to skip in the beginning of the file.
+    num_records : int
+        Number of records to yield after the skipped records.
+    thin : int
+        Yield every `thin`th record after the skipped records.
+
+    Yields
+    ------
+    p_dict : dict
+    """
+    with open(filepath) as fo:
+        try:
+            next(fo)
+        except StopIteration:
+            raise ValueError('No records to process in p-file.')
+        reader = csv.DictReader(fo, delimiter='\t')
+        yield from islice(islice(reader, skip, None, thin), num_records)
+
+
+def count_records(filepath):
+    """Count the records in a MrBayes p-file without storing them."""
+    with open(filepath) as fo:
+        num_lines = sum(1 for line in fo if line.strip() != '')
+    return max(num_lines - 2, 0)  # ID line and header
+
+
+def iter_records(
+        run_paths, skip=0, burnin_frac=None, thin=1, num_records=None):
+    """
+    Iterate lazily over paired records from one or more MrBayes runs.
+
+    The runs are concatenated in the given order. Burn-in and thinning
+    are applied to each run separately, whereas `num_records` applies
+    to the combined stream.
+
+    Parameters
+    ----------
+    run_paths : list of tuples
+        Paths to the p-file and t-file of each run.
+    skip : int
+        Number of records to skip in the beginning of each run.
+    burnin_frac : float
+        Fraction of records to skip in the beginning of each run.
+        Overrides `skip` if set.
+    thin : int
+        Yield every `thin`th record after the skipped records.
+    num_records : int
+        Total number of records to yield.
+
+    Yields
+    ------
+    tree : dendropy.Tree
+    p_dict : dict
+    """
+    taxon_namespace = dendropy.TaxonNamespace()
+
+    def iter_run(pfile_path, tfile_path):
+        if burnin_frac is None:
+            run_skip = skip
+        else:
+            run_skip = int(burnin_frac * count_records(pfile_path))
+        trees = iter_tfile(
+            tfile_path, run_skip, thin=thin, taxon_namespace=taxon_namespace)
+        p_dicts = iter_pfile(pfile_path, run_skip, thin=thin)
+        return pair_records(trees, p_dicts)
+
+    records = chain.from_iterable(
+        iter_run(pfile_path, tfile_path)
+        for pfile_path, tfile_path in run_paths)
+    return islice(records, num_records)
+
+
+def follow_records(
+        pfile_path, tfile_path, skip=0, thin=1, num_records=None,
+        state_filepath=None, timeout=None, poll_interval=1.,
+        max_buffered=100):
+    """
+    Iterate over paired records while MrBayes is still writing them.
+
+    Only complete lines are read. MrBayes ends the t-file with "end;"
+    after each tree and overwrites it with the next tree, so reading
+    always resumes at the start of that line.
+
+    Parameters
+    ----------
+    pfile_path : str
+    tfile_path : str
+    skip : int
+        Number of records to skip in the beginning of the files.
+    thin : int
+        Yield every `thin`th record after the skipped records.
+    num_records : int
+        Number of records to yield before stopping.
+    state_filepath : str (default: None)
+        Path to a file where the position in the p-file and t-file is
+        stored after each processed record, together with the ID of the
+        analysis. If the file exists, reading resumes from the stored
+        position, provided that the ID matches.
+    timeout : float (default: None)
+        Stop after this many seconds without new records. If `None`,
+        follow the files until interrupted.
+    poll_interval : float (default: 1.)
+        Seconds to wait before looking for new records.
+    max_buffered : int (default: 100)
+        Maximum number of unpaired records to keep in memory for each
+        file. Reading catches up gradually with files that are far
+        ahead, e.g. when starting late in an analysis.
+
+    Yields
+    ------
+    tree : dendropy.Tree
+    p_dict : dict
+    """
+    state = {
+        'mrbayes_id': None, 'pfile_offset': None, 'tfile_offset': None,
+        'num_records': 0}
+    resumed = state_filepath is not None and os.path.isfile(state_filepath)
+    if resumed:
+        with open(state_filepath) as fo:
+            state.update(json.load(fo))
+    taxon_namespace = dendropy.TaxonNamespace()
+    fieldnames = tree_header = None
+    tree_lines = deque()
+    p_dicts = deque()
+    num_yielded = 0
+    last_record_time = time.time()
+
+    with open(pfile_path, 'rb') as pfile_fo, \
+            open(tfile_path, 'rb') as tfile_fo:
+        while num_records is None or num_yielded < num_records:
+            if fieldnames is None:
+                pfile_header = read_pfile_header(
+                    pfile_fo, state['pfile_offset'])
+                if pfile_header is not None:
+                    id_line, fieldnames = pfile_header
+                    if resumed and state['mrbayes_id'] != id_line:
+                        raise ValueError(
+                            'State file ' + state_filepath + ' does not '
+                            'belong to the analysis in ' + pfile_path + '.')
+                    state['mrbayes_id'] = id_line
+            if tree_header is None and fieldnames is not None:
+                tree_header = read_tfile_header(
+                    tfile_fo, state['tfile_offset'])
+                if (tree_header is not None and
+                        state['mrbayes_id'] not in tree_header):
+                    raise ValueError(
+                        'The p-file and t-file are from different analyses.')
+            if fieldnames is not None:
+                p_dicts.extend(tail_pfile(
+                    pfile_fo, fieldnames, max_buffered - len(p_dicts)))
+            if tree_header is not None:
+                tree_lines.extend(tail_tfile(
+                    tfile_fo, max_buffered - len(tree_lines)))
+
+            if not (tree_lines and p_dicts):
+                if (timeout is not None and
+                        time.time() - last_record_time > timeout):
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            while tree_lines and p_dicts:
+                tree_line, state['tfile_offset'] = tree_lines.popleft()
+                p_dict, state['pfile_offset'] = p_dicts.popleft()
+                index = state['num_records']
+                state['num_records'] += 1
+                if index >= skip and (index - skip) % thin == 0:
+                    tree = dendropy.TreeList.get(
+                        data=tree_header + tree_line + 'end;\n',
+                        schema='nexus', taxon_namespace=taxon_namespace)[0]
+                    yield tree, p_dict
+                    num_yielded += 1
+                if state_filepath is not None:
+                    write_follow_state(state_filepath, state)
+                if num_records is not None and num_yielded >= num_records:
+                    return
+            last_record_time = time.time()
+
+
+def iter_complete_lines(fo):
+    """
+    Iterate over complete lines from the current position in a binary
+    file object, leaving the position at the start of any partial line.
+
+    Yields
+    ------
+    line : str
+    start : int
+        Position at the start of the line.
+    end : int
+        Position after the line.
+    """
+    while True:
+        start = fo.tell()
+        line = fo.readline()
+        if not line.endswith(b'\n'):
+            fo.seek(start)
+            return
+        yield line.decode('utf-8'), start, fo.tell()
+
+
+def read_pfile_header(fo, offset=None):
+    """
+    Read the ID line and the column names from a MrBayes p-file that
+    is being written.
+
+    Returns `None` if the header is not yet complete. Otherwise, the
+    position is moved to `offset` or to the first record.
+
+    Returns
+    -------
+    id_line : str
+        Line identifying the analysis, e.g. "[ID: 2773333307]".
+    fieldnames : list
+    """
+    fo.seek(0)
+    lines = list(islice(iter_complete_lines(fo), 2))  # ID line and header
+    if len(lines) < 2:
+        fo.seek(0)
+        return None
+    if offset is not None:
+        fo.seek(offset)
+    return lines[0][0].strip(), lines[1][0].rstrip('\r\n').split('\t')
+
+
+def read_tfile_header(fo, offset=None):
+    """
+    Read everything before the first tree in a MrBayes t-file that
+    is being written.
+
+    Returns `None` if no complete tree has been written yet. Otherwise,
+    the position is moved to `offset` or to the first tree.
+    """
+    fo.seek(0)
+    header_lines = []
+    for line, start, end in iter_complete_lines(fo):
+        if line.lstrip().startswith('tree '):
+            fo.seek(start if offset is None else offset)
+            return ''.join(header_lines)
+        header_lines.append(line)
+    fo.seek(0)
+    return None
+
+
+def tail_pfile(fo, fieldnames, max_records=None):
+    """
+    Return up to `max_records` new records in a p-file, with the
+    position after each.
+    """
+    records = []
+    if max_records is not None and max_records < 1:
+        return records
+    for line, start, end in iter_complete_lines(fo):
+        if line.strip() == '':
+            continue
+        values = line.rstrip('\r\n').split('\t')
+        records.append((dict(zip(fieldnames, values)), end))
+        if max_records is not None and len(records) >= max_records:
+            break
+    return records
+
+
+def tail_tfile(fo, max_records=None):
+    """
+    Return up to `max_records` new tree lines in a t-file, with the
+    position after each.
+    """
+    tree_lines = []
+    if max_records is not None and max_records < 1:
+        return tree_lines
+    for line, start, end in iter_complete_lines(fo):
+        stripped = line.strip()
+        if stripped == '':
+            continue
+        if not (stripped.startswith('tree ') and stripped.endswith(';')):
+            fo.seek(start)  # "end;" or a tree being written over it
+            break
+        tree_lines.append((line, end))
+        if max_records is not None and len(tree_lines) >= max_records:
+            break
+    return tree_lines
+
+
+def write_follow_state(filepath, state):
+    """Replace the content of a state file in a single step."""
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w') as fo:
+        json.dump(state, fo)
+    os.replace(tmp_filepath, filepath)
+
+
+def sample_records(records, sample_size, rng_seed=None):
+    """
+    Draw records uniformly at random in a single pass.
+
+    Reservoir sampling is used, so that no more than `sample_size`
+    records are kept in memory at the same time.
+
+    Parameters
+    ----------
+    records : iterable
+    sample_size : int
+        Number of records to draw. All records are returned if
+        there are fewer of them.
+    rng_seed : int (default: None)
+        Seed for the random number generator. If `None`,
+        the system time or another source of randomness is used.
+
+    Returns
+    -------
+    sampled_records : list
+        Records in the order they appear in the input.
+    """
+    rng = random.Random(rng_seed)
+    reservoir = []
+    for i, record in enumerate(records):
+        if i < sample_size:
+            reservoir.append((i, record))
+        else:
+            j = rng.randint(0, i)
+            if j < sample_size:
+                reservoir[j] = (i, record)
+    return [record for i, record in sorted(reservoir, key=lambda x: x[0])]
+
+
+def pair_records(trees, p_dicts):
+    """Pair trees with parameter values, checking that the counts match."""
+    sentinel = object()
+    for tree, p_dict in zip_longest(trees, p_dicts, fillvalue=sentinel):
+        if tree is sentinel or p_dict is sentinel:
+            raise ValueError(
+                'Number of trees does not match the number of records '
+                'with parameter values.')
+        yield tree, p_dict
+
+
 class StoreExpandedPath(argparse.Action):
     """Invoke shell-like path expansion for user- and relative paths."""
 
     def __call__(self, parser, namespace, values, option_string=None):
-        if values:
-            filepath = os.path.abspath(os.path.expanduser(str(values)))
-            setattr(namespace, self.dest, filepath)
+        if isinstance(values, list):
+            filepaths = [expand_path(value) for value in values]
+            setattr(namespace, self.dest, filepaths)
+        elif values:
+            setattr(namespace, self.dest, expand_path(values))
+
+
+def expand_path(path):
+    """Return an absolute path with any user directory expanded."""
+    return os.path.abspath(os.path.expanduser(str(path)))
 
 
 def is_file(filename):
@@ -194,6 +823,47 @@ def is_file(filename):
         return filename
 
 
+def is_positive_int(string):
+    """Check if a string represents a positive integer."""
+    try:
+        value = int(string)
+    except ValueError:
+        value = 0
+    if value < 1:
+        msg = '{0} is not a positive integer'.format(string)
+        raise argparse.ArgumentTypeError(msg)
+    return value
+
+
+def is_positive_int_list(string):
+    """Check if a string represents comma-separated positive integers."""
+    return [is_positive_int(value) for value in string.split(',')]
+
+
+def is_positive_float(string):
+    """Check if a string represents a positive number."""
+    try:
+        value = float(string)
+    except ValueError:
+        value = 0.
+    if not value > 0.:
+        msg = '{0} is not a positive number'.format(string)
+        raise argparse.ArgumentTypeError(msg)
+    return value
+
+
+def is_fraction(string):
+    """Check if a string represents a number in the interval [0, 1)."""
+    try:
+        value = float(string)
+    except ValueError:
+        value = -1.
+    if not 0. <= value < 1.:
+        msg = '{0} is not a number in the interval [0, 1)'.format(string)
+        raise argparse.ArgumentTypeError(msg)
+    return value
+
+
 def kappa_to_titv(kappa, piA, piC, piG, piT):
     """Calculate transistion/transversion ratio from kappa."""
     tot = piA + piC + piG + piT
@@ -261,9 +931,82 @@ def get_seqgen_params(mrbayes_params, basefreqs=None):
         seqgen_params['prop_invar'] = str(mrbayes_params['pinvar'])
     except KeyError:
         pass
+    try:
+        seqgen_params['scale_branch_lens'] = str(mrbayes_params['m'])
+    except KeyError:
+        pass
     return seqgen_params
 
 
+def get_partition_seqgen_params(mrbayes_params, basefreqs=None):
+    """
+    Adapt MrBayes parameter values of a single partition for use with
+    Seq-Gen.
+
+    Unlike `get_seqgen_params`, base frequences in the parameter values
+    are never overridden. `basefreqs` are only used for partitions
+    without base frequences, e.g. under a model with fixed frequences,
+    and equal frequences are used if `basefreqs` is `None`.
+    """
+    if all('pi(' + base + ')' in mrbayes_params for base in 'ACGT'):
+        basefreqs = None
+    elif basefreqs is None:
+        basefreqs = [0.25, 0.25, 0.25, 0.25]
+    return get_seqgen_params(mrbayes_params, basefreqs=basefreqs)
+
+
+PARTITION_PATTERN = re.compile(
+    r'^(?P<name>[^{]+)\{(?P<partitions>[^}]+)\}(?P<suffix>.*)$')
+
+
+def split_partition_params(mrbayes_params):
+    """
+    Split parameter values from a partitioned analysis by partition.
+
+    Column names in the p-file of a partitioned analysis contain the
+    numbers of the partitions that the parameter applies to, e.g.
+    `pi{1}(A)`, `r{1,2}(A<->C)` or `TL{all}`.
+
+    Parameters
+    ----------
+    mrbayes_params : dict
+        Parameter values from a single row in a MrBayes p-file.
+
+    Returns
+    -------
+    partition_params : list of dicts
+        Parameter values for each partition, ordered by partition number
+        and named as in an unpartitioned analysis. A single dict if all
+        parameters are shared by all partitions (`{all}`), and empty if
+        the analysis is not partitioned.
+    """
+    shared_params = {}
+    params_by_partition = {}
+    is_partitioned = False
+    for key, value in mrbayes_params.items():
+        match = PARTITION_PATTERN.match(key)
+        if match is None:
+            shared_params[key] = value
+            continue
+        is_partitioned = True
+        name = match.group('name') + match.group('suffix')
+        partitions = match.group('partitions')
+        if partitions == 'all':
+            shared_params[name] = value
+            continue
+        for partition in partitions.split(','):
+            params_by_partition.setdefault(int(partition), {})[name] = value
+    if not is_partitioned:
+        return []
+    if not params_by_partition:
+        return [shared_params]
+    num_partitions = max(params_by_partition)
+    partition_params = [
+        dict(shared_params, **params_by_partition.get(partition, {}))
+        for partition in range(1, num_partitions + 1)]
+    return partition_params
+
+
 def combine_simulation_input(tree_list, p_dicts, rng_seeds=None):
     """Combine input for multiple simulations."""
     assert len(p_dicts) == len(tree_list), (
@@ -278,22 +1021,228 @@ def combine_simulation_input(tree_list, p_dicts, rng_seeds=None):
     return zipped
 
 
+def iter_simulation_input(records, rng_seeds=None):
+    """
+    Lazily combine input for multiple simulations.
+
+    Unlike `combine_simulation_input`, the records are not counted in
+    advance, so a shortage of seed numbers is reported when reached.
+
+    Parameters
+    ----------
+    records : iterable
+        Pairs of trees and parameter values, e.g. from `iter_records`.
+    rng_seeds : list (default: None)
+        Seed numbers, one for each record.
+
+    Yields
+    ------
+    tree : dendropy.Tree
+    p_dict : dict
+    rng_seed : str or None
+    """
+    rng_seed_iter = repeat(None) if rng_seeds is None else iter(rng_seeds)
+    num_records = 0
+    for tree, p_dict in records:
+        try:
+            rng_seed = next(rng_seed_iter)
+        except StopIteration:
+            raise ValueError(
+                'There must be at least ' + str(num_records + 1) +
+                ' seed numbers.')
+        num_records += 1
+        yield tree, p_dict, rng_seed
+    if num_records == 0:
+        raise ValueError('No records to process!')
+
+
 def iter_seqgen_results(
         simulation_input, seq_len=1000, gamma_cats=None, basefreqs=None,
-        seqgen_path='seq-gen'):
-    """Iterate over multiple simulations."""
-    for tree, p_dict, rng_seed in simulation_input:
-        seqgen_params = get_seqgen_params(p_dict, basefreqs=basefreqs)
-        result = simulate_matrix(
-            tree, seq_len=seq_len, rng_seed=rng_seed,
-            seqgen_path=seqgen_path, **seqgen_params)
-        yield result
+        seqgen_path='seq-gen', partition_lengths=None, max_workers=None):
+    """
+    Iterate over multiple simulations.
+
+    Records from a partitioned analysis are simulated with
+    `simulate_partitions`, using a pool of `max_workers` threads,
+    and `seq_len` is not used for them. `partition_lengths` must
+    not be given for records from an unpartitioned analysis. See
+    `get_partition_input` for records where all parameters are shared
+    by all partitions.
+    """
+    with ThreadPoolExecutor(max_workers) as executor:
+        for tree, p_dict, rng_seed in simulation_input:
+            partition_input = get_partition_input(
+                p_dict, seq_len=seq_len, partition_lengths=partition_lengths)
+            if len(partition_input) > 1:
+                partition_params, seq_lens = zip(*partition_input)
+                result = simulate_partitions(
+                    tree, list(partition_params), list(seq_lens),
+                    basefreqs=basefreqs, rng_seed=rng_seed,
+                    seqgen_path=seqgen_path, executor=executor)
+            else:
+                [(params, params_seq_len)] = partition_input
+                seqgen_params = get_seqgen_params(params, basefreqs=basefreqs)
+                result = simulate_matrix(
+                    tree, seq_len=params_seq_len, rng_seed=rng_seed,
+                    seqgen_path=seqgen_path, **seqgen_params)
+            yield result
+
+
+def get_partition_input(mrbayes_params, seq_len=1000, partition_lengths=None):
+    """
+    Match the parameter values of a record with sequence lengths.
+
+    Parameters shared by all partitions (`{all}`) are simulated as a
+    single dataset of length `seq_len`, or repeated for each length in
+    `partition_lengths` if given.
+
+    Parameters
+    ----------
+    mrbayes_params : dict
+        Parameter values from a single row in a MrBayes p-file.
+    seq_len : int (default: 1000)
+        Sequence length for unpartitioned analyses.
+    partition_lengths : list of ints (default: None)
+        Sequence lengths of the partitions in a partitioned analysis.
+
+    Returns
+    -------
+    partition_input : list of tuples
+        Parameter values, named as in an unpartitioned analysis, and
+        sequence length for each dataset to simulate.
+    """
+    partition_params = split_partition_params(mrbayes_params)
+    if not partition_params:
+        check_partition_lengths(partition_lengths, 0)
+        return [(mrbayes_params, seq_len)]
+    if len(partition_params) == 1:
+        if partition_lengths is None:
+            return [(partition_params[0], seq_len)]
+        partition_params = partition_params * len(partition_lengths)
+    check_partition_lengths(partition_lengths, len(partition_params))
+    return list(zip(partition_params, partition_lengths))
+
+
+def simulate_partitions(
+        tree, partition_params, partition_lengths, basefreqs=None,
+        rng_seed=None, seqgen_path='seq-gen', executor=None):
+    """
+    Simulate the partitions of a dataset concurrently with Seq-Gen.
+
+    Parameters
+    ----------
+    tree : dendropy.Tree
+        Tree shared by all partitions.
+    partition_params : list of dicts
+        MrBayes parameter values for each partition, as returned by
+        `split_partition_params`.
+    partition_lengths : list of ints
+        Length of sequences to simulate for each partition.
+    basefreqs : list of floats (default: None)
+        Frequences for the four nucleotides A, C, G, and T to use for
+        partitions without base frequences in MrBayes output. If `None`,
+        equal frequences are used for them.
+    rng_seed : int (default: None)
+        Seed for generating a seed number for each partition. If `None`,
+        seed numbers will be generated automatically.
+    seqgen_path : str (default: "seq-gen")
+        Path to Seq-Gen executable.
+    executor : concurrent.futures.Executor (default: None)
+        Executor for running the simulations. If `None`, a thread pool
+        with one thread per partition is used.
+
+    Returns
+    -------
+    result : SeqGenResult
+        Concatenated result with one character subset per partition.
+    """
+    check_partition_lengths(partition_lengths, len(partition_params))
+    rng = random.Random(rng_seed)
+    with ExitStack() as cm:
+        if executor is None:
+            executor = cm.enter_context(
+                ThreadPoolExecutor(len(partition_params)))
+        futures = []
+        for params, seq_len in zip(partition_params, partition_lengths):
+            seqgen_params = get_partition_seqgen_params(
+                params, basefreqs=basefreqs)
+            partition_seed = (
+                None if rng_seed is None else rng.randint(0, sys.maxsize))
+            futures.append(executor.submit(
+                simulate_matrix, tree, seq_len=seq_len,
+                rng_seed=partition_seed, seqgen_path=seqgen_path,
+                **seqgen_params))
+        results = [future.result() for future in futures]
+    return concatenate_results(results)
+
+
+def check_partition_lengths(partition_lengths, num_partitions):
+    """
+    Check that partition lengths are given for all partitions, and only
+    for partitioned analyses (`num_partitions` is 0 if unpartitioned).
+    """
+    if num_partitions == 0:
+        if partition_lengths is not None:
+            raise ValueError(
+                'Partition lengths were given, but the analysis '
+                'is not partitioned.')
+    elif partition_lengths is None:
+        raise ValueError(
+            'Partition lengths must be provided for partitioned analyses.')
+    elif len(partition_lengths) != num_partitions:
+        raise ValueError(
+            'Number of partition lengths (' + str(len(partition_lengths)) +
+            ') does not match the number of partitions (' +
+            str(num_partitions) + ').')
+
+
+def check_model_params(records, basefreqs=None, partition_lengths=None):
+    """
+    Check that all records have the parameter values needed for
+    simulating datasets, without running any simulations.
+
+    Raises
+    ------
+    KeyError
+        If base frequences are missing.
+    ValueError
+        If there are no records or the partition lengths do not
+        match the records.
+    """
+    if not records:
+        raise ValueError('No records to process!')
+    for tree, p_dict in records:
+        partition_input = get_partition_input(
+            p_dict, partition_lengths=partition_lengths)
+        if len(partition_input) > 1:
+            for params, seq_len in partition_input:
+                get_partition_seqgen_params(params, basefreqs=basefreqs)
+        else:
+            get_seqgen_params(partition_input[0][0], basefreqs=basefreqs)
+
+
+def concatenate_results(results):
+    """
+    Concatenate results from simulations of separate partitions.
+
+    The character matrices are concatenated in the given order, with
+    a character subset for each partition. All results are assumed to
+    come from the same tree.
+    """
+    char_matrices = []
+    for i, result in enumerate(results, start=1):
+        result.char_matrix.label = 'partition' + str(i)
+        char_matrices.append(result.char_matrix)
+    char_matrix = type(char_matrices[0]).concatenate(char_matrices)
+    return SeqGenResult(
+        char_matrix, ''.join(result.command for result in results),
+        results[0].tree)
 
 
 def simulate_matrix(
         tree, seq_len=1000, state_freqs=None, ti_tv=None, general_rates=None,
-        gamma_shape=None, gamma_cats=None, prop_invar=None, rng_seed=None,
-        seqgen_path='seq-gen'):
+        gamma_shape=None, gamma_cats=None, prop_invar=None,
+        scale_branch_lens=None, rng_seed=None, seqgen_path='seq-gen'):
     """
     Simulate a dataset with Seq-Gen.
 
@@ -314,6 +1263,9 @@ def simulate_matrix(
         use a continous gamma distribution.
     prop_invar : float (default: None)
         Proportion of invariable sites.
+    scale_branch_lens : float (default: None)
+        Factor for scaling branch lengths, e.g. a partition-specific
+        rate multiplier.
     rng_seed : int (default: None)
         Seed for the random number generator. If `None`,
         a seed number will be generated automatically.
@@ -341,6 +1293,7 @@ def simulate_matrix(
     s.gamma_shape = gamma_shape
     s.gamma_cats = gamma_cats
     s.prop_invar = prop_invar
+    s.scale_branch_lens = scale_branch_lens
     s.rng_seed = rng_seed
     result = SeqGenResult(
         s.generate(tree).char_matrices[0],
@@ -369,5 +1322,335 @@ def get_write_func(fo, field):
     return write_to_file
 
 
+def check_observed_matrix(char_matrix):
+    """
+    Check that an observed alignment only contains the states A, C, G
+    and T, since gaps, missing data and ambiguities never occur in the
+    simulated alignments.
+    """
+    for taxon in char_matrix:
+        other_states = set(str(char_matrix[taxon]).upper()) - set('ACGT')
+        if other_states:
+            raise ValueError(
+                'The observed sequence of {0} contains states other than '
+                'A, C, G and T: {1}.'.format(
+                    taxon.label, ' '.join(sorted(other_states))))
+
+
+def check_taxon_labels(records, taxon_labels):
+    """
+    Iterate over records, checking that the taxon labels of each tree
+    match the given labels.
+    """
+    taxon_labels = set(taxon_labels)
+    for tree, p_dict in records:
+        tree_labels = {leaf.taxon.label for leaf in tree.leaf_node_iter()}
+        if tree_labels != taxon_labels:
+            raise ValueError(
+                'The taxon labels of tree "{0}" do not match the observed '
+                'alignment.'.format(tree.label))
+        yield tree, p_dict
+
+
+def site_pattern_counts(char_matrix):
+    """Count the occurrences of each site pattern in a character matrix."""
+    sequences = [str(char_matrix[taxon]) for taxon in char_matrix]
+    return Counter(zip(*sequences))
+
+
+def multinomial_loglik(char_matrix):
+    """
+    Calculate the multinomial log-likelihood of a character matrix,
+    i.e. the log-likelihood under a model where site patterns occur
+    independently at the frequences observed in the matrix.
+    """
+    pattern_counts = site_pattern_counts(char_matrix)
+    num_sites = sum(pattern_counts.values())
+    return sum(
+        count * log(count / num_sites) for count in pattern_counts.values())
+
+
+def count_site_patterns(char_matrix):
+    """Count the unique site patterns in a character matrix."""
+    return len(site_pattern_counts(char_matrix))
+
+
+def count_variable_sites(char_matrix):
+    """Count the sites with more than one state in a character matrix."""
+    pattern_counts = site_pattern_counts(char_matrix)
+    return sum(
+        count for pattern, count in pattern_counts.items()
+        if len(set(pattern)) > 1)
+
+
+TEST_STATISTICS = {
+    'multinomial': multinomial_loglik,
+    'patterns': count_site_patterns,
+    'variable-sites': count_variable_sites}
+
+
+def iter_predictive_tests(results, observed_stat, statistic_func):
+    """
+    Keep a running posterior predictive test over simulation results.
+
+    The test is updated after each result, so that the caller can stop
+    drawing results once the estimates are precise enough.
+
+    Parameters
+    ----------
+    results : iterable
+        Simulation results, e.g. from `iter_seqgen_results`.
+    observed_stat : float
+        Test statistic for the observed data.
+    statistic_func : function
+        Function for calculating the test statistic from a
+        character matrix.
+
+    Yields
+    ------
+    result : SeqGenResult
+    test : PredictiveTest
+        Test based on all results so far.
+    """
+    num_replicates = num_extreme = 0
+    mean = sum_sq = 0.
+    for result in results:
+        stat = statistic_func(result.char_matrix)
+        num_replicates += 1
+        if stat >= observed_stat:
+            num_extreme += 1
+        delta = stat - mean  # Welford's algorithm
+        mean += delta / num_replicates
+        sum_sq += delta * (stat - mean)
+        variance = sum_sq / (num_replicates - 1) if num_replicates > 1 else 0.
+        # Standard error from a shrunken estimate of the p-value, to
+        # avoid a zero standard error when all replicates agree
+        shrunken = (num_extreme + 1) / (num_replicates + 2)
+        test = PredictiveTest(
+            num_replicates, observed_stat, mean,
+            sqrt(variance / num_replicates),
+            num_extreme / num_replicates,
+            sqrt(shrunken * (1 - shrunken) / num_replicates))
+        yield result, test
+
+
+PredictiveTest = namedtuple(
+    'PredictiveTest', [
+        'num_replicates', 'observed_stat', 'mean_stat', 'mean_stat_se',
+        'pvalue', 'pvalue_se'])
+
+
+def format_predictive_test(test, stop_reason=None):
+    """
+    Format a posterior predictive test as a short report, optionally
+    with the reason for not simulating more replicates.
+    """
+    lines = [
+        'Replicates: {0}'.format(test.num_replicates),
+        'Observed statistic: {0:g}'.format(test.observed_stat),
+        'Mean simulated statistic: {0:g} (SE {1:g})'.format(
+            test.mean_stat, test.mean_stat_se),
+        'P-value: {0:g} (SE {1:g})'.format(test.pvalue, test.pvalue_se)]
+    if stop_reason is not None:
+        lines.append('Stopped: {0}'.format(stop_reason))
+    return '\n'.join(lines) + '\n'
+
+
+class PosteriorServer(socketserver.UnixStreamServer):
+    """
+    Server that keeps records in memory and simulates datasets on request.
+
+    The server listens on a Unix socket. Each request is handled in a
+    pool of worker threads by reading a single line with a JSON object,
+    with the following optional keys:
+
+    start, stop : int
+        Range of records to use (default: all records).
+    length : int
+        Sequence length (default: 1000).
+    partition_lengths : list of ints
+        Sequence lengths of the partitions in a partitioned analysis
+        (default: as set for the server).
+    replicates : int
+        Number of datasets to simulate for each record (default: 1).
+    seed : int
+        Seed for generating seed numbers for the simulations.
+    format : str
+        Output format, "nexus" or "phylip" (default: "nexus").
+
+    A line with a JSON object is sent back after each simulation, with
+    the keys "matrix", "command" and "tree". If the request fails, the
+    last line sent back has the key "error".
+
+    Parameters
+    ----------
+    socket_path : str
+    records : list
+        Pairs of trees and parameter values, e.g. from `iter_records`.
+    max_workers : int (default: None)
+        Number of requests to handle concurrently.
+    **simulation_kwargs
+        Keyword arguments for `iter_seqgen_results`.
+    """
+    request_keys = {
+        'start', 'stop', 'length', 'partition_lengths', 'replicates',
+        'seed', 'format'}
+
+    def __init__(
+            self, socket_path, records, max_workers=None,
+            **simulation_kwargs):
+        self.records = records
+        self.simulation_kwargs = simulation_kwargs
+        self.executor = ThreadPoolExecutor(max_workers)
+        super().__init__(socket_path, PosteriorRequestHandler)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(
+            self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+    def iter_results(self, request):
+        """Iterate over the simulation results for a request."""
+        unknown_keys = set(request) - self.request_keys
+        if unknown_keys:
+            raise ValueError(
+                'Unknown request keys: ' + ', '.join(sorted(unknown_keys)))
+        records = self.records[request.get('start'):request.get('stop')]
+        if not records:
+            raise ValueError('No records to process!')
+        replicates = request.get('replicates', 1)
+        check_positive_int('replicates', replicates)
+        length = request.get('length', 1000)
+        check_positive_int('length', length)
+        simulation_kwargs = dict(self.simulation_kwargs)
+        if 'partition_lengths' in request:
+            partition_lengths = request['partition_lengths']
+            if not isinstance(partition_lengths, list):
+                raise ValueError(
+                    '"partition_lengths" must be a list of positive '
+                    'integers.')
+            for partition_length in partition_lengths:
+                check_positive_int('partition_lengths', partition_length)
+            simulation_kwargs['partition_lengths'] = partition_lengths
+        out_format = request.get('format', 'nexus')
+        if out_format not in OUTPUT_SCHEMAS:
+            raise ValueError('Unknown output format: ' + str(out_format))
+
+        seed = request.get('seed')
+        rng = random.Random(seed)
+        simulation_input = (
+            (tree, p_dict,
+             None if seed is None else rng.randint(0, sys.maxsize))
+            for tree, p_dict in records for _ in range(replicates))
+        results = iter_seqgen_results(
+            simulation_input, seq_len=length, **simulation_kwargs)
+        for result in results:
+            yield {
+                'matrix': result.char_matrix.as_string(
+                    **OUTPUT_SCHEMAS[out_format]),
+                'command': result.command,
+                'tree': result.tree}
+
+
+def check_positive_int(name, value):
+    """Check that a request value is a positive integer."""
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(
+            '"' + name + '" must be a positive integer, not ' +
+            json.dumps(value) + '.')
+
+
+class PosteriorRequestHandler(socketserver.StreamRequestHandler):
+    """Handle a simulation request sent to a `PosteriorServer`."""
+
+    def handle(self):
+        try:
+            self.respond()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client disconnected, nobody to report to
+
+    def respond(self):
+        try:
+            line = self.rfile.readline()
+            if not line:  # closed without a request
+                return
+            request = json.loads(line.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object.')
+            for response in self.server.iter_results(request):
+                self.write_response(response)
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+        except Exception as exc:
+            self.write_response({'error': format_error(exc)})
+
+    def write_response(self, response):
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove a socket file left behind by a server that is no longer
+    running. Raise OSError if the path is used by a running server
+    or is not a socket.
+    """
+    if not os.path.exists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        raise OSError('{0} exists and is not a socket'.format(socket_path))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+    raise OSError(
+        'another server is listening on {0}'.format(socket_path))
+
+
+def format_error(exc):
+    """Return the message of an exception, without quotes for KeyError."""
+    if isinstance(exc, KeyError) and exc.args:
+        return str(exc.args[0])
+    return str(exc)
+
+
+def request_simulations(socket_path, **request):
+    """
+    Send a simulation request to a `PosteriorServer`.
+
+    Parameters
+    ----------
+    socket_path : str
+    **request
+        Request keys as described for `PosteriorServer`.
+
+    Yields
+    ------
+    response : dict
+        Simulation result with the keys "matrix", "command" and "tree".
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as fo:
+            for line in fo:
+                response = json.loads(line)
+                if 'error' in response:
+                    raise RuntimeError(response['error'])
+                yield response
+
+
 if __name__ == '__main__':  # pragma: no cover
     main()
@@ -2,22 +2,59 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import math
 import os
+import socket
 import subprocess
 import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
 
 import pytest
 import dendropy
 
+import predsim
+
 from predsim import (
     read_tfile,
     read_pfile,
+    iter_tfile,
+    iter_pfile,
+    count_records,
+    iter_records,
+    follow_records,
+    read_pfile_header,
+    read_tfile_header,
+    tail_pfile,
+    tail_tfile,
+    sample_records,
     kappa_to_titv,
     get_seqgen_params,
+    get_partition_seqgen_params,
+    split_partition_params,
+    get_partition_input,
     simulate_matrix,
+    simulate_partitions,
+    concatenate_results,
+    SeqGenResult,
+    multinomial_loglik,
+    count_site_patterns,
+    count_variable_sites,
+    iter_predictive_tests,
+    format_predictive_test,
     combine_simulation_input,
+    iter_simulation_input,
     iter_seqgen_results,
     parse_args,
+    parse_serve_args,
+    PosteriorServer,
+    remove_stale_socket,
+    check_model_params,
+    check_observed_matrix,
+    check_taxon_labels,
+    request_simulations,
     main,
     is_file,)
 
@@ -32,6 +69,17 @@ def get_testfile_path(filename):
     return os.path.join(test_file_dir, filename)
 
 
+def read_testfile_lines(filename):
+    """Return the lines of a test file."""
+    with open(get_testfile_path(filename)) as fo:
+        return fo.readlines()
+
+
+def make_results(char_matrices):
+    """Return simulation results with only character matrices set."""
+    return [SeqGenResult(char_matrix, '', '') for char_matrix in char_matrices]
+
+
 def get_model_testfile_paths(model_string, num_records=1, ext='.nex'):
     """
     Return the paths to all test files for a given substitution
@@ -92,6 +140,176 @@ class TestReadParameterFile():
             read_pfile(str(fo.dirpath('empty-p-file.txt')))
 
 
+class TestIterRecords():
+
+    hky_paths = (get_testfile_path('hky.p'), get_testfile_path('hky.t'))
+    jc_paths = (get_testfile_path('jc.p'), get_testfile_path('jc.t'))
+
+    def test_iter_tfile(self):
+        trees = list(iter_tfile(self.hky_paths[1], skip=1))
+        assert [tree.label for tree in trees] == ['gen.500', 'gen.1000']
+
+    def test_iter_pfile_thin(self):
+        p_dicts = list(iter_pfile(self.hky_paths[0], thin=2))
+        assert [p_dict['Gen'] for p_dict in p_dicts] == ['0', '1000']
+
+    def test_iter_empty_pfile(self, tmpdir):
+        fo = tmpdir.join('empty-p-file.txt')
+        fo.write('')
+        with pytest.raises(ValueError):
+            list(iter_pfile(str(fo)))
+
+    def test_count_records(self):
+        assert count_records(self.hky_paths[0]) == 3
+
+    def test_single_run(self):
+        records = list(iter_records([self.hky_paths], skip=1))
+        assert len(records) == 2
+        assert records[0][0].label == 'gen.500'
+        assert records[0][1]['Gen'] == '500'
+
+    def test_multiple_runs(self):
+        records = list(iter_records(
+            [self.hky_paths, self.jc_paths], burnin_frac=0.5, thin=2))
+        assert [p_dict['Gen'] for tree, p_dict in records] == ['500', '500']
+        assert records[0][0].taxon_namespace is records[1][0].taxon_namespace
+
+    def test_num_records(self):
+        records = list(iter_records(
+            [self.hky_paths, self.jc_paths], num_records=4))
+        assert len(records) == 4
+
+    def test_record_mismatch(self, tmpdir):
+        fo = tmpdir.join('short-p-file.txt')
+        with open(self.hky_paths[0]) as pfile_fo:
+            fo.write(''.join(pfile_fo.readlines()[:-1]))
+        with pytest.raises(ValueError):
+            list(iter_records([(str(fo), self.hky_paths[1])]))
+
+
+class TestFollowRecords():
+
+    pfile_lines = read_testfile_lines('hky.p')
+    tfile_lines = read_testfile_lines('hky.t')
+
+    def write_files(self, tmpdir, num_trees, num_p_records, partial=None):
+        """
+        Write files the way MrBayes does while still running, with an
+        optional partial tree line overwriting the final "end;".
+        """
+        pfile = tmpdir.join('run.p')
+        tfile = tmpdir.join('run.t')
+        pfile.write(''.join(self.pfile_lines[:2 + num_p_records]))
+        tfile.write(''.join(
+            self.tfile_lines[:-4] +
+            self.tfile_lines[-4:-1][:num_trees]) + (partial or 'end;\n'))
+        return str(pfile), str(tfile)
+
+    def follow(self, pfile_path, tfile_path, **kwargs):
+        return list(follow_records(
+            pfile_path, tfile_path, timeout=0, poll_interval=0, **kwargs))
+
+    def test_complete_records(self, tmpdir):
+        records = self.follow(*self.write_files(tmpdir, 3, 3))
+        assert [tree.label for tree, p_dict in records] == [
+            'gen.0', 'gen.500', 'gen.1000']
+        assert records[2][1]['Gen'] == '1000'
+        assert records[0][0].as_string('newick') == read_tfile(
+            get_testfile_path('hky.t'))[0].as_string('newick')
+
+    def test_unpaired_records(self, tmpdir):
+        records = self.follow(*self.write_files(tmpdir, 3, 1))
+        assert len(records) == 1
+
+    def test_partial_tree(self, tmpdir):
+        partial = '   tree gen.1500 = [&U] (2:1.0e-01,'
+        records = self.follow(*self.write_files(tmpdir, 2, 3, partial))
+        assert len(records) == 2
+
+    def test_no_trees(self, tmpdir):
+        assert self.follow(*self.write_files(tmpdir, 0, 3)) == []
+
+    def test_skip_thin_num_records(self, tmpdir):
+        paths = self.write_files(tmpdir, 3, 3)
+        records = self.follow(*paths, skip=1, thin=2)
+        assert [p_dict['Gen'] for tree, p_dict in records] == ['500']
+        assert len(self.follow(*paths, num_records=2)) == 2
+
+    def test_resume(self, tmpdir):
+        state_filepath = str(tmpdir.join('state.json'))
+        paths = self.write_files(tmpdir, 1, 2)
+        records = self.follow(*paths, state_filepath=state_filepath)
+        assert [p_dict['Gen'] for tree, p_dict in records] == ['0']
+        with open(paths[1], 'r+') as fo:  # overwrite "end;"
+            fo.seek(0, os.SEEK_END)
+            fo.seek(fo.tell() - len('end;\n'))
+            fo.write(''.join(self.tfile_lines[-3:]))
+        records = self.follow(*paths, state_filepath=state_filepath)
+        assert [p_dict['Gen'] for tree, p_dict in records] == ['500']
+        assert self.follow(*paths, state_filepath=state_filepath) == []
+
+    def test_max_buffered(self, tmpdir):
+        records = self.follow(
+            *self.write_files(tmpdir, 3, 3), max_buffered=1)
+        assert [p_dict['Gen'] for tree, p_dict in records] == [
+            '0', '500', '1000']
+
+    def test_tail_limit(self, tmpdir):
+        pfile_path, tfile_path = self.write_files(tmpdir, 3, 3)
+        with open(tfile_path, 'rb') as fo:
+            read_tfile_header(fo)
+            assert len(tail_tfile(fo, 2)) == 2
+            assert len(tail_tfile(fo, 2)) == 1
+            assert tail_tfile(fo, 2) == []
+        with open(pfile_path, 'rb') as fo:
+            id_line, fieldnames = read_pfile_header(fo)
+            assert id_line == '[ID: 8013756541]'
+            assert len(tail_pfile(fo, fieldnames, 1)) == 1
+            assert tail_pfile(fo, fieldnames, 0) == []
+            assert len(tail_pfile(fo, fieldnames)) == 2
+
+    def test_resume_other_analysis(self, tmpdir):
+        state_filepath = str(tmpdir.join('state.json'))
+        pfile_path, tfile_path = self.write_files(tmpdir, 1, 1)
+        self.follow(pfile_path, tfile_path, state_filepath=state_filepath)
+        for path in [pfile_path, tfile_path]:  # MrBayes restarted
+            with open(path) as fo:
+                content = fo.read()
+            with open(path, 'w') as fo:
+                fo.write(content.replace('8013756541', '1234567890'))
+        with pytest.raises(ValueError):
+            self.follow(
+                pfile_path, tfile_path, state_filepath=state_filepath)
+
+    def test_different_analyses(self):
+        with pytest.raises(ValueError):
+            self.follow(
+                get_testfile_path('hky.p'), get_testfile_path('jc.t'))
+
+
+class TestSampleRecords():
+
+    def test_sample_size(self):
+        sampled = sample_records(range(100), 10, rng_seed=1)
+        assert len(sampled) == 10
+        assert sampled == sorted(sampled)
+
+    def test_deterministic(self):
+        assert (
+            sample_records(range(100), 10, rng_seed=1) ==
+            sample_records(iter(range(100)), 10, rng_seed=1))
+
+    def test_few_records(self):
+        assert sample_records(range(3), 10, rng_seed=1) == [0, 1, 2]
+
+    def test_sample_posterior(self):
+        records = iter_records([(
+            get_testfile_path('hky.p'), get_testfile_path('hky.t'))])
+        sampled = sample_records(records, 2, rng_seed=1)
+        assert len(sampled) == 2
+        assert sampled[0][0].label == 'gen.' + sampled[0][1]['Gen']
+
+
 class TestKappaConversion():
 
     def test_equal_basefreqs(self):
@@ -121,6 +339,113 @@ class TestGetSeqGenParamaters():
         with pytest.raises(KeyError):
             get_seqgen_params(self.d3)
 
+    def test_rate_multiplier(self):
+        seqgen_params = get_seqgen_params(dict(self.d1, m='2.0'))
+        assert seqgen_params['scale_branch_lens'] == '2.0'
+
+
+class TestGetPartitionSeqGenParameters():
+
+    d1 = {'pi(A)': '0.1', 'pi(C)': '0.2', 'pi(G)': '0.3', 'pi(T)': '0.4'}
+    basefreqs = [0.4, 0.3, 0.2, 0.1]
+
+    def test_own_basefreqs(self):
+        seqgen_params = get_partition_seqgen_params(
+            self.d1, basefreqs=self.basefreqs)
+        assert seqgen_params['state_freqs'] == '0.1,0.2,0.3,0.4'
+
+    def test_fallback_basefreqs(self):
+        seqgen_params = get_partition_seqgen_params(
+            {}, basefreqs=self.basefreqs)
+        assert seqgen_params['state_freqs'] == '0.4,0.3,0.2,0.1'
+
+    def test_equal_basefreqs(self):
+        seqgen_params = get_partition_seqgen_params({'kappa': '2'})
+        assert seqgen_params['state_freqs'] == '0.25,0.25,0.25,0.25'
+
+
+class TestSplitPartitionParameters():
+
+    p_dict = {
+        'Gen': '0',
+        'TL{all}': '0.5',
+        'pi{1}(A)': '0.1',
+        'alpha{2}': '0.3',
+        'r{1,2}(A<->C)': '0.2',
+        'm{1}': '0.8',
+        'm{2}': '1.2'}
+
+    def test_unpartitioned(self):
+        assert split_partition_params({'Gen': '0', 'pi(A)': '0.25'}) == []
+
+    def test_partitioned(self):
+        params1, params2 = split_partition_params(self.p_dict)
+        assert params1 == {
+            'Gen': '0', 'TL': '0.5', 'pi(A)': '0.1', 'r(A<->C)': '0.2',
+            'm': '0.8'}
+        assert params2 == {
+            'Gen': '0', 'TL': '0.5', 'alpha': '0.3', 'r(A<->C)': '0.2',
+            'm': '1.2'}
+
+    def test_shared_params(self):
+        p_dict = {'Gen': '0', 'pi(A){all}': '0.1', 'alpha{all}': '0.3'}
+        assert split_partition_params(p_dict) == [
+            {'Gen': '0', 'pi(A)': '0.1', 'alpha': '0.3'}]
+
+    def test_partition_input_unpartitioned(self):
+        p_dict = {'pi(A)': '0.25'}
+        assert get_partition_input(p_dict, seq_len=3) == [(p_dict, 3)]
+        with pytest.raises(ValueError):
+            get_partition_input(p_dict, partition_lengths=[3])
+
+    def test_partition_input_shared(self):
+        p_dict = {'alpha{all}': '0.3'}
+        params = {'alpha': '0.3'}
+        assert get_partition_input(p_dict, seq_len=3) == [(params, 3)]
+        assert get_partition_input(p_dict, partition_lengths=[3, 4]) == [
+            (params, 3), (params, 4)]
+
+    def test_partition_input_partitioned(self):
+        partition_input = get_partition_input(
+            self.p_dict, seq_len=3, partition_lengths=[4, 5])
+        assert [seq_len for params, seq_len in partition_input] == [4, 5]
+        with pytest.raises(ValueError):
+            get_partition_input(self.p_dict, seq_len=3)
+
+    def test_check_shared_params(self):
+        p_dict = {
+            'pi(A){all}': '0.1', 'pi(C){all}': '0.2', 'pi(G){all}': '0.3',
+            'pi(T){all}': '0.4'}
+        check_model_params([(None, p_dict)])
+        check_model_params([(None, p_dict)], partition_lengths=[2, 3])
+
+    def test_partition_without_params(self):
+        partition_params = split_partition_params({'m{1}': '1', 'm{3}': '1'})
+        assert partition_params[1] == {}
+
+
+class TestConcatenateResults():
+
+    taxon_namespace = dendropy.TaxonNamespace(['t1', 't2'])
+    results = [
+        SeqGenResult(
+            dendropy.DnaCharacterMatrix.from_dict(
+                {'t1': 'AC', 't2': 'GT'}, taxon_namespace=taxon_namespace),
+            'command1\n', '(t1,t2);\n'),
+        SeqGenResult(
+            dendropy.DnaCharacterMatrix.from_dict(
+                {'t1': 'AAA', 't2': 'GGG'}, taxon_namespace=taxon_namespace),
+            'command2\n', '(t1,t2);\n')]
+
+    def test_concatenate(self):
+        result = concatenate_results(self.results)
+        assert result.char_matrix.sequence_size == 5
+        assert str(result.char_matrix[0]) == 'ACAAA'
+        assert sorted(result.char_matrix.character_subsets) == [
+            'partition1', 'partition2']
+        assert result.command == 'command1\ncommand2\n'
+        assert result.tree == '(t1,t2);\n'
+
 
 @seqgen_required
 class TestSingleSimulation():
@@ -169,6 +494,51 @@ class TestSingleSimulation():
             simulate_matrix(
                 self.tree, gamma_cats=5, seqgen_path=SEQGEN_PATH)
 
+    def test_scale_branch_lens(self):
+        result = simulate_matrix(
+            self.tree, scale_branch_lens=2, seqgen_path=SEQGEN_PATH)
+        assert ' -s2 ' in result.command
+
+
+class TestPartitionedSimulation():
+
+    tree_string = '((t1:0,t2:0):0,t3:0,t4:0);'
+    tree = dendropy.Tree.get_from_string(tree_string, 'newick')
+    partition_params = [
+        {'alpha': '0.5', 'm': '0.5'},
+        {'r(A<->C)': '1', 'r(A<->G)': '1', 'r(A<->T)': '1',
+         'r(C<->G)': '1', 'r(C<->T)': '1', 'r(G<->T)': '1', 'm': '1.5'}]
+    basefreqs = [0.25, 0.25, 0.25, 0.25]
+
+    @seqgen_required
+    def test_simulate_partitions(self):
+        result = simulate_partitions(
+            self.tree, self.partition_params, [3, 4],
+            basefreqs=self.basefreqs, rng_seed='123321',
+            seqgen_path=SEQGEN_PATH)
+        assert result.char_matrix.sequence_size == 7
+        assert result.command.count('\n') == 2
+        assert ' -s1.5 ' in result.command
+
+    def test_missing_lengths(self):
+        with pytest.raises(ValueError):
+            simulate_partitions(
+                self.tree, self.partition_params, None,
+                basefreqs=self.basefreqs, seqgen_path=SEQGEN_PATH)
+
+    def test_unpartitioned_with_lengths(self):
+        simulation_input = [(self.tree, {'pi(A)': '0.25'}, None)]
+        with pytest.raises(ValueError):
+            list(iter_seqgen_results(
+                simulation_input, basefreqs=self.basefreqs,
+                partition_lengths=[3, 4], seqgen_path=SEQGEN_PATH))
+
+    def test_length_mismatch(self):
+        with pytest.raises(ValueError):
+            simulate_partitions(
+                self.tree, self.partition_params, [3],
+                basefreqs=self.basefreqs, seqgen_path=SEQGEN_PATH)
+
 
 class TestCombineSimulationInput():
 
@@ -213,6 +583,29 @@ class TestCombineSimulationInput():
                 self.treelist, self.p_dicts, rng_seeds=self.rng_seeds[:1])
 
 
+class TestIterSimulationInput():
+
+    records = [('tree1', {}), ('tree2', {})]
+
+    def test_input(self):
+        simulation_input = iter_simulation_input(
+            self.records, ['123321', '456654'])
+        assert list(simulation_input)[1] == ('tree2', {}, '456654')
+
+    def test_no_seeds(self):
+        simulation_input = iter_simulation_input(self.records)
+        assert [rng_seed for _, _, rng_seed in simulation_input] == [
+            None, None]
+
+    def test_empty_input(self):
+        with pytest.raises(ValueError):
+            list(iter_simulation_input([]))
+
+    def test_rng_seeds_mismatch(self):
+        with pytest.raises(ValueError):
+            list(iter_simulation_input(self.records, ['123321']))
+
+
 @seqgen_required
 class TestIterSeqgenResults():
 
@@ -273,6 +666,129 @@ class TestArgumentParser():
         assert parser.seeds_filepath == seeds_filepath
         assert parser.pfile_path == pfile_path
         assert parser.tfile_path == tfile_path
+        assert parser.run_paths == [(pfile_path, tfile_path)]
+
+    def test_parser_multiple_runs(self):
+        pfile_path = get_testfile_path('hky.p')
+        tfile_path = get_testfile_path('hky.t')
+        parser = parse_args([
+            '--burnin-frac', '0.25', '--thin', '2',
+            pfile_path, tfile_path, pfile_path, tfile_path])
+        assert parser.burnin_frac == 0.25
+        assert parser.thin == 2
+        assert parser.run_paths == [(pfile_path, tfile_path)] * 2
+
+    def test_parser_follow(self):
+        parser = parse_args([
+            '--follow', '--follow-timeout', '60',
+            '--state-file', self.commands_fo.name,
+            get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+        assert parser.follow is True
+        assert parser.follow_timeout == 60
+        assert parser.state_filepath == self.commands_fo.name
+
+    def test_parser_follow_sample(self):
+        with pytest.raises(SystemExit):
+            parse_args([
+                '--follow', '--sample', '2',
+                get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+
+    def test_parser_partition_lengths(self):
+        parser = parse_args([
+            '--partition-lengths', '300,200',
+            get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+        assert parser.partition_lengths == [300, 200]
+
+    def test_parser_observed(self):
+        observed_filepath = get_testfile_path('hky_1_exp.nex')
+        parser = parse_args([
+            '--observed', observed_filepath, '--statistic', 'patterns',
+            '--precision', '0.01',
+            get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+        assert parser.observed_filepath == observed_filepath
+        assert parser.observed_format == 'nexus'
+        assert parser.statistic == 'patterns'
+        assert parser.precision == 0.01
+        assert parser.max_replicates is None
+
+    def test_parser_max_replicates(self):
+        parser = parse_args([
+            '--max-replicates', '100',
+            get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+        assert parser.max_replicates == 100
+
+    def test_parser_observed_length(self):
+        parser = parse_args([
+            '--observed', get_testfile_path('hky_1_exp.nex'),
+            get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+        assert parser.length == 2
+
+    @pytest.mark.parametrize(
+        'length_args', [
+            ['-l', '1000'],
+            ['--partition-lengths', '1,2']])
+    def test_parser_observed_length_mismatch(self, length_args):
+        with pytest.raises(SystemExit):
+            parse_args(length_args + [
+                '--observed', get_testfile_path('hky_1_exp.nex'),
+                get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+
+    def test_parser_observed_other_states(self, tmpdir):
+        observed_file = tmpdir.join('observed.fasta')
+        observed_file.write('>t1\nG-\n>t2\nGT\n>t3\nCT\n>t4\nGT\n')
+        with pytest.raises(SystemExit):
+            parse_args([
+                '--observed', str(observed_file),
+                '--observed-format', 'fasta',
+                get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+
+    def test_parser_default_length(self):
+        parser = parse_args([
+            get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+        assert parser.length == 1000
+
+    def test_parser_precision_without_observed(self):
+        with pytest.raises(SystemExit):
+            parse_args([
+                '--precision', '0.01',
+                get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+
+    @pytest.mark.parametrize('value', ['0', '-0.01', 'nan', 'x'])
+    def test_parser_nonpositive_precision(self, value):
+        with pytest.raises(SystemExit):
+            parse_args([
+                '--observed', get_testfile_path('hky_1_exp.nex'),
+                '--precision', value,
+                get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+
+    def test_parser_sample_seed_without_sample(self):
+        with pytest.raises(SystemExit):
+            parse_args([
+                '--sample-seed', '42',
+                get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+
+    def test_parser_sample(self):
+        parser = parse_args([
+            '--sample', '10', '--sample-seed', '42',
+            get_testfile_path('hky.p'), get_testfile_path('hky.t')])
+        assert parser.sample_size == 10
+        assert parser.sample_seed == 42
+
+    def test_parser_unpaired_run(self):
+        pfile_path = get_testfile_path('hky.p')
+        tfile_path = get_testfile_path('hky.t')
+        with pytest.raises(SystemExit):
+            parse_args([pfile_path, tfile_path, pfile_path])
+
+    @pytest.mark.parametrize(
+        'option', [
+            ['--burnin-frac', '1'],
+            ['--thin', '0'],
+            ['-s', '1', '--burnin-frac', '0.5']])
+    def test_parser_invalid_burnin(self, option):
+        with pytest.raises(SystemExit):
+            parse_args(option + [
+                get_testfile_path('hky.p'), get_testfile_path('hky.t')])
 
     def test_is_file(self):
         with tempfile.NamedTemporaryFile() as tmp:
@@ -283,6 +799,244 @@ class TestArgumentParser():
             is_file('')
 
 
+class TestTestStatistics():
+
+    char_matrix = dendropy.DnaCharacterMatrix.from_dict(
+        {'t1': 'AACG', 't2': 'AACT', 't3': 'AACT'})
+
+    def test_multinomial_loglik(self):
+        assert multinomial_loglik(self.char_matrix) == pytest.approx(
+            2 * math.log(0.5) + 2 * math.log(0.25))
+
+    def test_count_site_patterns(self):
+        assert count_site_patterns(self.char_matrix) == 3
+
+    def test_count_variable_sites(self):
+        assert count_variable_sites(self.char_matrix) == 1
+
+    def test_check_observed_matrix(self):
+        check_observed_matrix(self.char_matrix)
+
+    @pytest.mark.parametrize('sequence', ['AA-T', 'AA?T', 'AANT', 'AART'])
+    def test_check_observed_matrix_other_states(self, sequence):
+        char_matrix = dendropy.DnaCharacterMatrix.from_dict(
+            {'t1': 'AACG', 't2': sequence})
+        with pytest.raises(ValueError) as excinfo:
+            check_observed_matrix(char_matrix)
+        assert 't2' in str(excinfo.value)
+
+    def test_check_taxon_labels(self):
+        run_paths = [(get_testfile_path('hky.p'), get_testfile_path('hky.t'))]
+        records = list(iter_records(run_paths))
+        checked = check_taxon_labels(records, ['t4', 't3', 't2', 't1'])
+        assert list(checked) == records
+        with pytest.raises(ValueError):
+            list(check_taxon_labels(records, ['t1', 't2', 't3']))
+        with pytest.raises(ValueError):
+            list(check_taxon_labels(records, ['t1', 't2', 't3', 't5']))
+
+
+class TestPredictiveTests():
+
+    results = make_results([1., 3., 2., 4.])
+
+    def test_running_test(self):
+        tests = [test for result, test in iter_predictive_tests(
+            self.results, 2.5, lambda stat: stat)]
+        assert [test.num_replicates for test in tests] == [1, 2, 3, 4]
+        assert tests[-1].observed_stat == 2.5
+        assert tests[-1].mean_stat == pytest.approx(2.5)
+        assert tests[-1].mean_stat_se == pytest.approx(
+            math.sqrt(5 / 3 / 4))
+        assert tests[-1].pvalue == 0.5
+        assert tests[-1].pvalue_se == pytest.approx(math.sqrt(0.25 / 4))
+
+    def test_nonzero_pvalue_se(self):
+        result, test = next(iter_predictive_tests(
+            self.results, 10., lambda stat: stat))
+        assert test.pvalue == 0.
+        assert test.pvalue_se > 0.
+
+    def test_stop_early(self):
+        results = iter(self.results)
+        for result, test in iter_predictive_tests(
+                results, 0., lambda stat: stat):
+            if test.num_replicates == 2:
+                break
+        assert len(list(results)) == 2
+
+    def test_format(self):
+        result, test = next(iter_predictive_tests(
+            self.results, 0., lambda stat: stat))
+        report = format_predictive_test(test)
+        assert 'Replicates: 1\n' in report
+        assert 'P-value: 1 ' in report
+        assert 'Stopped' not in report
+        report = format_predictive_test(test, 'precision reached')
+        assert report.endswith('Stopped: precision reached\n')
+
+
+class TestPosteriorServer():
+
+    run_paths = [(get_testfile_path('hky.p'), get_testfile_path('hky.t'))]
+    jc_run_paths = [(get_testfile_path('jc.p'), get_testfile_path('jc.t'))]
+
+    @contextmanager
+    def run_server(self, tmpdir, run_paths):
+        socket_path = str(tmpdir.join('predsim.sock'))
+        records = list(iter_records(run_paths))
+        server = PosteriorServer(
+            socket_path, records, max_workers=2, seqgen_path=SEQGEN_PATH)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            yield socket_path
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    @pytest.fixture
+    def socket_path(self, tmpdir):
+        with self.run_server(tmpdir, self.run_paths) as socket_path:
+            yield socket_path
+
+    @seqgen_required
+    def test_request(self, socket_path):
+        responses = list(request_simulations(
+            socket_path, start=1, length=2, replicates=2, seed=1))
+        assert len(responses) == 4
+        assert responses[0]['matrix'].startswith('#NEXUS')
+        assert ' -l2 ' in responses[0]['command']
+
+    @seqgen_required
+    def test_concurrent_requests(self, socket_path):
+        iterators = [
+            request_simulations(socket_path, length=2, format='phylip')
+            for _ in range(3)]
+        assert [len(list(iterator)) for iterator in iterators] == [3] * 3
+
+    @pytest.mark.parametrize(
+        'request_kwargs', [
+            {'start': 3},
+            {'replicates': 0},
+            {'length': 0},
+            {'length': '2'},
+            {'length': 2.5},
+            {'length': True},
+            {'partition_lengths': 2},
+            {'partition_lengths': [2, 0]},
+            {'format': 'fasta'},
+            {'unknown': 1}])
+    def test_invalid_request(self, socket_path, request_kwargs):
+        with pytest.raises(RuntimeError):
+            list(request_simulations(socket_path, **request_kwargs))
+
+    def test_client_disconnect(self, tmpdir, capsys):
+        with self.run_server(tmpdir, self.jc_run_paths) as socket_path:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+                sock.sendall(b'{"replicates": 100}\n')
+            time.sleep(1)  # let the server handle the request
+        out, err = capsys.readouterr()
+        assert err == ''
+
+    def test_missing_basefreqs(self, tmpdir):
+        with self.run_server(tmpdir, self.jc_run_paths) as socket_path:
+            with pytest.raises(RuntimeError) as excinfo:
+                list(request_simulations(socket_path, length=2))
+        assert 'Base frequences must be provided' in str(excinfo.value)
+
+    def test_serve_missing_basefreqs(self, tmpdir):
+        pfile_path, tfile_path = self.jc_run_paths[0]
+        with pytest.raises(SystemExit) as excinfo:
+            main([
+                'serve', str(tmpdir.join('predsim.sock')),
+                pfile_path, tfile_path])
+        assert 'Base frequences must be provided' in str(excinfo.value)
+        assert not tmpdir.join('predsim.sock').check()
+
+    def test_serve_mismatched_run(self, tmpdir):
+        pfile_path, tfile_path = self.jc_run_paths[0]
+        lines = read_testfile_lines('jc.p')
+        short_pfile = tmpdir.join('short.p')
+        short_pfile.write(''.join(lines[:-1]))
+        with pytest.raises(SystemExit) as excinfo:
+            main([
+                'serve', str(tmpdir.join('predsim.sock')),
+                str(short_pfile), tfile_path])
+        assert 'Number of trees does not match' in str(excinfo.value)
+        assert not tmpdir.join('predsim.sock').check()
+
+    def test_check_model_params(self):
+        records = list(iter_records(self.jc_run_paths))
+        check_model_params(records, basefreqs=[0.25, 0.25, 0.25, 0.25])
+        with pytest.raises(KeyError):
+            check_model_params(records)
+        with pytest.raises(ValueError):
+            check_model_params(
+                records, basefreqs=[0.25, 0.25, 0.25, 0.25],
+                partition_lengths=[2])
+
+    def test_remove_stale_socket(self, tmpdir):
+        socket_path = str(tmpdir.join('stale.sock'))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(socket_path)
+        sock.close()
+        remove_stale_socket(socket_path)
+        assert not os.path.exists(socket_path)
+        remove_stale_socket(socket_path)  # nothing to remove
+
+    def test_remove_live_socket(self, socket_path):
+        with pytest.raises(OSError):
+            remove_stale_socket(socket_path)
+        assert os.path.exists(socket_path)
+
+    def test_remove_regular_file(self, tmpdir):
+        fo = tmpdir.join('predsim.sock')
+        fo.write('')
+        with pytest.raises(OSError):
+            remove_stale_socket(str(fo))
+        assert fo.check()
+
+    def test_parse_serve_args(self):
+        pfile_path, tfile_path = self.run_paths[0]
+        parser = parse_serve_args([
+            '-w', '4', '-s', '1', '/tmp/predsim.sock',
+            pfile_path, tfile_path])
+        assert parser.max_workers == 4
+        assert parser.skip == 1
+        assert parser.socket_path == '/tmp/predsim.sock'
+        assert parser.run_paths == self.run_paths
+
+    def test_serve_help(self):
+        with pytest.raises(SystemExit):
+            main(['serve', '-h'])
+
+
+class TestMainInterrupted():
+
+    def test_interrupted_report(self, capsys, monkeypatch):
+        observed_filepath = get_testfile_path('hky_1_exp.nex')
+        char_matrix = dendropy.DnaCharacterMatrix.get(
+            path=observed_filepath, schema='nexus')
+
+        def interrupted_results(*args, **kwargs):
+            yield SeqGenResult(char_matrix, '', '')
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(
+            predsim, 'iter_seqgen_results', interrupted_results)
+        main([
+            '--observed', observed_filepath,
+            get_testfile_path('hky.p'),
+            get_testfile_path('hky.t')])
+        out, err = capsys.readouterr()
+        assert out.count('#NEXUS') == 1
+        assert err.startswith('Replicates: 1\n')
+        assert err.endswith('Stopped: interrupted\n')
+
+
 @seqgen_required
 class TestMain():
 
@@ -370,6 +1124,29 @@ class TestMain():
         assert out == expected_out
         assert err == ''
 
+    def test_hky_precision(self, capsys):
+        main([
+            '-l', '2', '--observed', get_testfile_path('hky_1_exp.nex'),
+            '--precision', '1',
+            get_testfile_path('hky.p'),
+            get_testfile_path('hky.t')])
+        out, err = capsys.readouterr()
+        assert out.count('#NEXUS') == 1
+        assert err.startswith('Replicates: 1\n')
+        assert err.endswith('Stopped: precision reached\n')
+
+    def test_hky_max_replicates(self, capsys):
+        main([
+            '--observed', get_testfile_path('hky_1_exp.nex'),
+            '--precision', '0.0001', '--max-replicates', '2',
+            get_testfile_path('hky.p'),
+            get_testfile_path('hky.t')])
+        out, err = capsys.readouterr()
+        assert out.count('#NEXUS') == 2
+        assert err.startswith('Replicates: 2\n')
+        assert err.endswith(
+            'Stopped: maximum number of replicates reached\n')
+
     def test_gtr(self, capsys):
         pfile_path, tfile_path, expected_path = get_model_testfile_paths(
             'gtr', num_records=1, ext='.nex')